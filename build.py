@@ -1,15 +1,44 @@
 #!/usr/bin/env python3.8
 import os
+import sys
+import copy
 import json
+import logging
 import time
-
-from tarfile import TarFile, TarInfo, DIRTYPE
-from typing import Union, TypedDict, Optional, IO
-from io import BytesIO
+import shutil
+import tempfile
+import subprocess
+
+from tarfile import TarFile, TarInfo, DIRTYPE, BLOCKSIZE, NUL
+from typing import (
+    Union,
+    TypedDict,
+    Optional,
+    IO,
+    Set,
+    Iterator,
+    Iterable,
+    Any,
+    cast,
+    TYPE_CHECKING,
+)
+from io import BytesIO, IOBase, UnsupportedOperation
+from gzip import GzipFile
+from contextlib import contextmanager, suppress
 
 from unix_ar import ArFile, ArInfo
 import click
 
+if TYPE_CHECKING:
+    from _typeshed import SupportsRead
+
+try:
+    import orjson
+except ImportError:
+    orjson = None  # type: ignore[assignment]
+
+
+logger = logging.getLogger(__name__)
 
 DEB_VERSION = b"2.0\n"
 
@@ -25,6 +54,8 @@ webOS-Package-Format-Version: 2
 webOS-Packager-Version: x.y.x
 """
 DIRECTORY_SIZE = 4096
+COPY_BUFSIZE = 1024 * 1024
+COMPRESS_LEVEL = 6
 
 
 class AppInfo(TypedDict):
@@ -44,14 +75,14 @@ class AppInfo(TypedDict):
     disableBackHistoryAPI: bool
 
 
-def get_appinfo(base_path) -> AppInfo:
+def get_appinfo(base_path: str) -> AppInfo:
     appinfo_file = os.path.join(base_path, "appinfo.json")
 
     if not os.path.isfile(appinfo_file):
         raise ValueError
 
     with open(appinfo_file, "rt") as fh:
-        return json.load(fh)
+        return cast(AppInfo, json.load(fh))
 
 
 def gen_filename(appinfo: AppInfo) -> str:
@@ -66,7 +97,13 @@ def gen_packageinfo(appinfo: AppInfo) -> bytes:
         "vendor": appinfo["vendor"],
         "version": appinfo["version"],
     }
-    data = json.dumps(packageinfo, indent=2) + "\n"
+
+    if orjson is not None:
+        return orjson.dumps(packageinfo, option=orjson.OPT_INDENT_2) + b"\n"
+
+    # Unescaped UTF-8, so the output is identical to orjson's, which keeps
+    # packageinfo.json (and Installed-Size) independent of it being installed.
+    data = json.dumps(packageinfo, indent=2, ensure_ascii=False) + "\n"
 
     return data.replace("\r\n", "\n").encode("utf-8")
 
@@ -76,23 +113,26 @@ def gen_control(appinfo: AppInfo, size: int) -> bytes:
     return control.replace("\r\n", "\n").encode("utf-8")
 
 
-def calc_size(base_path: str) -> int:
-    size = 0
-    for base, dirs, files in os.walk(base_path):
-        for d in dirs:
-            size += DIRECTORY_SIZE
-
-        for f in files:
-            filepath = os.path.join(base, f)
-            filesize = os.stat(filepath).st_size
-            size += filesize
-    return size
+def _normalize_tarinfo(info: TarInfo, mtime: int) -> TarInfo:
+    info.mtime = mtime
+    info.mode = 0o777 if info.isdir() else 0o666
+    info.uid = 1000
+    info.gid = 1000
+    info.uname = ""
+    info.gname = ""
+    return info
 
 
 FileData = Union[str, bytes, IO[bytes]]
 
 
-def ar_addfile(ar: ArFile, name: str, data: FileData, size: Optional[int] = None):
+def ar_addfile(
+    ar: ArFile,
+    name: str,
+    data: FileData,
+    size: Optional[int] = None,
+    mtime: Optional[int] = None,
+) -> None:
     if isinstance(data, str):
         data = data.encode("utf-8")
 
@@ -100,77 +140,223 @@ def ar_addfile(ar: ArFile, name: str, data: FileData, size: Optional[int] = None
         if size is None:
             size = len(data)
         data = BytesIO(data)
-
-    if size is None and data.seekable():
-        data.seek(0, os.SEEK_END)
-        size = data.tell()
+    elif data.seekable():
+        if size is None:
+            data.seek(0, os.SEEK_END)
+            size = data.tell()
+        data.seek(0)
 
     if size is None:
         raise ValueError("Unable to determine size, and no size provided.")
 
+    if mtime is None:
+        mtime = int(time.time())
+
     info = ArInfo(name)
     info.size = size
-    info.mtime = int(time.time())
+    info.mtime = mtime
     info.perms = 0o100644
     info.uid = 0
     info.gid = 0
 
-    if data.seekable():
-        data.seek(0)
-
     ar.addfile(info, data)
 
 
-def tar_addfile(tar: TarFile, name: str, data: FileData, size: Optional[int] = None):
+def _tar_addheader(tar: TarFile, info: TarInfo) -> None:
+    # Adds a member header only, for callers writing the payload themselves.
+    # TarFile.addfile() can't be used for that, since Python 3.13 it requires
+    # a fileobj for any non-empty regular file.
+    buf = info.tobuf(tar.format, tar.encoding, tar.errors)
+    tar.fileobj.write(buf)
+    tar.offset += len(buf)
+    tar.members.append(info)  # type: ignore[attr-defined]  # not in the stubs
+
+
+def tar_addfile(
+    tar: TarFile,
+    name: str,
+    data: FileData,
+    size: Optional[int] = None,
+    mtime: Optional[int] = None,
+) -> None:
     if isinstance(data, str):
         data = data.encode("utf-8")
 
     if isinstance(data, bytes):
         if size is None:
             size = len(data)
-        data = BytesIO(data)
-
-    if size is None and data.seekable():
-        data.seek(0, os.SEEK_END)
-        size = data.tell()
+    elif data.seekable():
+        if size is None:
+            data.seek(0, os.SEEK_END)
+            size = data.tell()
+        data.seek(0)
 
     if size is None:
         raise ValueError("Unable to determine size, and no size provided.")
 
-    name = name.replace(os.path.sep, "/")
-
-    members = tar.getnames()
-    dir_elements = name.split("/")[:-1]
-    if dir_elements:
-        for n in range(1, len(dir_elements) + 1):
-            dirpath = "/".join(dir_elements[:n])
-            if dirpath not in members:
-                dir_info = TarInfo(dirpath)
-                dir_info.mtime = int(time.time())
-                dir_info.mode = 0o777
-                dir_info.uid = 1000
-                dir_info.gid = 1000
-                dir_info.type = DIRTYPE
-
-                tar.addfile(dir_info)
+    if mtime is None:
+        mtime = int(time.time())
 
+    # name is an archive path, and is expected to be "/" separated already.
     info = TarInfo(name)
     info.size = size
-    info.mtime = int(time.time())
-    info.mode = 0o666
-    info.uid = 1000
-    info.gid = 1000
-
-    if data.seekable():
-        data.seek(0)
-
-    tar.addfile(info, data)
-
-
-def build(base_path: str, output: str):
-    appinfo = get_appinfo(base_path)
-    size = calc_size(base_path)
-    size += 4 * DIRECTORY_SIZE  # usr/palm/applications/{appinfo['id']}/
+    _normalize_tarinfo(info, mtime)
+
+    if not isinstance(data, bytes) or size != len(data):
+        tar.addfile(info, BytesIO(data) if isinstance(data, bytes) else data)
+        return
+
+    # Write in-memory payloads straight after the header, without wrapping
+    # them in a file object for tarfile to copy from.
+    _tar_addheader(tar, info)
+    tar.fileobj.write(data)
+
+    blocks, remainder = divmod(size, BLOCKSIZE)
+    if remainder > 0:
+        tar.fileobj.write(NUL * (BLOCKSIZE - remainder))
+        blocks += 1
+    tar.offset += blocks * BLOCKSIZE
+
+
+def tar_adddirs(
+    tar: TarFile, names: Iterable[str], mtime: Optional[int] = None
+) -> None:
+    # Adds entries for all parent directories of names, parents first.
+    if mtime is None:
+        mtime = int(time.time())
+
+    dirs: Set[str] = set()
+    for name in names:
+        dirpath = ""
+        for element in name.split("/")[:-1]:
+            dirpath = f"{dirpath}/{element}" if dirpath else element
+            dirs.add(dirpath)
+
+    for dirpath in sorted(dirs):
+        dir_info = TarInfo(dirpath)
+        dir_info.type = DIRTYPE
+
+        tar.addfile(_normalize_tarinfo(dir_info, mtime))
+
+
+class SendfileTarFile(TarFile):
+    # When streaming an uncompressed archive into a pipe ("w|"), member data is
+    # spliced from the source file by the kernel instead of being copied through
+    # Python.
+    #
+    # tarfile has no public way to write to the underlying file of a stream, so
+    # this relies on the private tarfile._Stream attributes: buf holds data not
+    # yet written to the pipe, and must be flushed before calling sendfile(), and
+    # pos is the stream position, which must account for the bytes sent. Both
+    # have been stable since Python 3.0; anything other than an uncompressed
+    # stream falls back to TarFile.addfile().
+
+    def addfile(
+        self, tarinfo: TarInfo, fileobj: "Optional[SupportsRead[bytes]]" = None
+    ) -> None:
+        stream: Any = self.fileobj
+
+        if (
+            not isinstance(fileobj, IOBase)
+            or sys.platform != "linux"
+            or getattr(stream, "comptype", None) != "tar"
+        ):
+            return super().addfile(tarinfo, fileobj)
+
+        try:
+            in_fd = fileobj.fileno()
+        except UnsupportedOperation:
+            return super().addfile(tarinfo, fileobj)
+
+        # Write the header only, then flush it ahead of the data.
+        self._check("awx")  # type: ignore[attr-defined]
+        tarinfo = copy.copy(tarinfo)
+        _tar_addheader(self, tarinfo)
+        stream.fileobj.write(stream.buf)
+        stream.fileobj.flush()
+        stream.buf = b""
+
+        out_fd = stream.fileobj.fileno()
+        offset = fileobj.tell()
+        remaining = tarinfo.size
+        while remaining > 0:
+            sent = os.sendfile(out_fd, in_fd, offset, remaining)
+            if sent == 0:
+                raise OSError("unexpected end of data")
+            offset += sent
+            remaining -= sent
+        stream.pos += tarinfo.size
+
+        blocks, remainder = divmod(tarinfo.size, BLOCKSIZE)
+        if remainder > 0:
+            stream.write(NUL * (BLOCKSIZE - remainder))
+            blocks += 1
+        self.offset += blocks * BLOCKSIZE
+
+
+@contextmanager
+def gzip_tarfile(
+    fileobj: IO[bytes],
+    compress_level: int = COMPRESS_LEVEL,
+    reproducible: bool = False,
+    parallel: bool = True,
+    **kwargs: Any,
+) -> Iterator[TarFile]:
+    # pigz compresses on all CPU cores, fall back to Python's gzip without it.
+    # Reproducible archives always use Python's gzip, as the compressed bytes
+    # would otherwise depend on whether pigz is installed.
+    pigz = shutil.which("pigz") if parallel and not reproducible else None
+
+    if pigz is None:
+        # Reproducible archives leave the timestamp in the gzip header empty.
+        with GzipFile(
+            fileobj=fileobj,
+            mode="wb",
+            compresslevel=compress_level,
+            mtime=0 if reproducible else None,
+        ) as gz:
+            with TarFile.open(mode="w", fileobj=gz, **kwargs) as tar:
+                yield tar
+        return
+
+    proc = subprocess.Popen(
+        [pigz, f"-{compress_level}", "-c"], stdin=subprocess.PIPE, stdout=fileobj
+    )
+    assert proc.stdin is not None
+    try:
+        with SendfileTarFile.open(mode="w|", fileobj=proc.stdin, **kwargs) as tar:
+            yield tar
+    except BrokenPipeError as e:
+        # pigz exited early, its exit status says more than the broken pipe.
+        proc.wait()
+        if proc.returncode != 0:
+            raise subprocess.CalledProcessError(proc.returncode, proc.args) from e
+        raise
+    finally:
+        with suppress(BrokenPipeError):
+            proc.stdin.close()
+        proc.wait()
+
+    if proc.returncode != 0:
+        raise subprocess.CalledProcessError(proc.returncode, proc.args)
+
+
+def build(
+    base_path: str,
+    output: str,
+    compress_level: int = COMPRESS_LEVEL,
+    appinfo: Optional[AppInfo] = None,
+    reproducible: bool = False,
+) -> None:
+    if appinfo is None:
+        appinfo = get_appinfo(base_path)
+
+    if reproducible:
+        # https://reproducible-builds.org/specs/source-date-epoch/
+        mtime = int(os.environ.get("SOURCE_DATE_EPOCH", 0))
+    else:
+        mtime = int(time.time())
+    size = 4 * DIRECTORY_SIZE  # usr/palm/applications/{appinfo['id']}/
 
     packageinfo_data = gen_packageinfo(appinfo)
 
@@ -179,44 +365,98 @@ def build(base_path: str, output: str):
 
     size += DIRECTORY_SIZE  # TODO: I'm one off comared to ares-package, why?
 
-    ar = ArFile(open(output, "wb"), "w")
-
-    ar_addfile(ar, "debian-binary", DEB_VERSION)
-
-    with BytesIO() as controlfh:
-        with TarFile.open(mode="w:gz", fileobj=controlfh) as control_tarfh:
-            control_data = gen_control(appinfo, size)
-            tar_addfile(control_tarfh, "control", control_data)
-
-        ar_addfile(ar, "control.tar.gz", controlfh)
+    output_base = f"usr/palm/applications/{appinfo['id']}"
+
+    def _filter(info: TarInfo) -> Optional[TarInfo]:
+        nonlocal size
+
+        if info.isdir():
+            # The application directory itself is accounted for above.
+            if info.name != output_base:
+                size += DIRECTORY_SIZE
+
+                # Like os.walk, count symlinked directories but don't descend
+                # into them, as they may point outside the tree or at a parent.
+                if os.path.islink(base_path + info.name[len(output_base) :]):
+                    logger.debug("Skipping %s, symlinked directory", info.name)
+                    return None
+        elif info.isfile():
+            size += info.size
+        else:
+            logger.debug("Skipping %s, not a file or directory", info.name)
+            return None
+
+        logger.debug("%s %d", info.name, info.size)
+
+        return _normalize_tarinfo(info, mtime)
+
+    # The data archive is written first, so that the installed size is known
+    # by the time the control file is generated, without walking the tree twice.
+    # It is spooled to disk rather than memory, as it holds the whole application.
+    with tempfile.TemporaryFile() as datafh, BytesIO() as controlfh:
+        with gzip_tarfile(
+            datafh,
+            compress_level,
+            reproducible=reproducible,
+            dereference=True,
+            copybufsize=COPY_BUFSIZE,
+        ) as data_tarfh:
+            packageinfo_name = f"usr/palm/packages/{appinfo['id']}/packageinfo.json"
 
-    with BytesIO() as datafh:
-        with TarFile.open(mode="w:gz", fileobj=datafh) as data_tarfh:
-            output_base = f"usr/palm/applications/{appinfo['id']}"
+            # tarfile only emits directory entries for the tree being added,
+            # so the remaining directories are all added up front.
+            tar_adddirs(data_tarfh, [output_base, packageinfo_name], mtime=mtime)
 
-            for base, dirs, files in os.walk(base_path):
-                rel_base = os.path.relpath(base, base_path)
+            data_tarfh.add(base_path, arcname=output_base, filter=_filter)
 
-                for file_name in files:
-                    input_file = os.path.join(base, file_name)
+            tar_addfile(data_tarfh, packageinfo_name, packageinfo_data, mtime=mtime)
 
-                    rel_file = os.path.relpath(input_file, base_path)
-                    archive_path = os.path.join(output_base, rel_file)
+        with gzip_tarfile(
+            controlfh,
+            compress_level,
+            reproducible=reproducible,
+            parallel=False,
+        ) as control_tarfh:
+            control_data = gen_control(appinfo, size)
+            logger.debug("Installed size: %d", size)
+            tar_addfile(control_tarfh, "control", control_data, mtime=mtime)
 
-                    with open(input_file, "rb") as fh:
-                        tar_addfile(data_tarfh, archive_path, fh)
+        ar = ArFile(open(output, "wb"), "w")
 
-            packageinfo_name = f"usr/palm/packages/{appinfo['id']}/packageinfo.json"
-            packageinfo_data = gen_packageinfo(appinfo)
-            tar_addfile(data_tarfh, packageinfo_name, packageinfo_data)
-
-        ar_addfile(ar, "data.tar.gz", datafh)
+        ar_addfile(ar, "debian-binary", DEB_VERSION, mtime=mtime)
+        ar_addfile(ar, "control.tar.gz", controlfh, mtime=mtime)
+        ar_addfile(ar, "data.tar.gz", datafh, mtime=mtime)
 
 
 @click.command()
 @click.argument("path", type=click.Path(exists=True, dir_okay=True, file_okay=False))
 @click.option("--output", type=click.Path(dir_okay=True, file_okay=True), default=None)
-def cli(path: str, output: Optional[str] = None):
+@click.option(
+    "--compress-level",
+    type=click.IntRange(0, 9),
+    default=COMPRESS_LEVEL,
+    show_default=True,
+)
+@click.option(
+    "--reproducible",
+    is_flag=True,
+    default=False,
+    help=(
+        "Use $SOURCE_DATE_EPOCH (or 0) as the timestamp of all members, and skip "
+        "optional accelerators. Output is identical for the same Python and zlib."
+    ),
+)
+@click.option("-v", "--verbose", is_flag=True, default=False)
+def cli(
+    path: str,
+    output: Optional[str] = None,
+    compress_level: int = COMPRESS_LEVEL,
+    reproducible: bool = False,
+    verbose: bool = False,
+) -> None:
+    if verbose:
+        logging.basicConfig(level=logging.DEBUG)
+
     appinfo = get_appinfo(path)
 
     if output is None:
@@ -226,7 +466,13 @@ def cli(path: str, output: Optional[str] = None):
     else:
         output_file = output
 
-    build(path, output=output_file)
+    build(
+        path,
+        output=output_file,
+        compress_level=compress_level,
+        appinfo=appinfo,
+        reproducible=reproducible,
+    )
     click.echo(output_file)
 
 
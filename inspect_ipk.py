@@ -19,9 +19,9 @@ print(repr(deb_version))
 
 print("Control:")
 control = ar_file.open("control.tar.gz")
-control_tar = tarfile.open(fileobj=control)
+control_tar = tarfile.open(fileobj=control, mode="r|gz")
 
-for obj in control_tar.getmembers():
+for obj in control_tar:
     print(
         obj.name,
         obj.pax_headers,
@@ -38,9 +38,9 @@ for obj in control_tar.getmembers():
 
 print("Data:")
 data = ar_file.open("data.tar.gz")
-data_tar = tarfile.open(fileobj=data)
+data_tar = tarfile.open(fileobj=data, mode="r|gz")
 
-for obj in data_tar.getmembers():
+for obj in data_tar:
     print(
         obj.name,
         obj.pax_headers,